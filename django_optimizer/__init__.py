@@ -3,3 +3,5 @@
 Django Optimizer application is an app, that will automatically optimize django queries
 """
 import monkey_patching
+
+default_app_config = 'django_optimizer.apps.DjangoOptimizerConfig'
@@ -2,8 +2,18 @@
 """
 Apps module
 """
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 
 
 class DjangoOptimizerConfig(AppConfig):
     name = 'django_optimizer'
+
+    def ready(self):
+        """
+        Wraps descriptors of all models, as class_prepared receiver handles only models prepared after it's connected,
+        models imported before this app (e.g. by apps earlier in INSTALLED_APPS) would be left without logging
+        """
+        from django_optimizer.monkey_patching import add_logging_descriptors
+
+        for model in apps.get_models():
+            add_logging_descriptors(model)
@@ -2,10 +2,73 @@
 """
 Cache module containing a definition of a PersistentFileBasedCache
 """
-import pickle
+import atexit
+import marshal
+import os
+import threading
+import time
 
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.core.cache.backends.filebased import FileBasedCache
 from django.core.cache.backends.locmem import LocMemCache
+from django.utils import six
+from django.utils.six.moves import cPickle as pickle
+
+_missing = object()
+_never_expires = pickle.dumps(None, pickle.HIGHEST_PROTOCOL)
+
+
+_marshal_types = frozenset((six.binary_type, six.text_type, float, bool, type(None)) + six.integer_types)
+"""
+Types of values, which are serialized with marshal (apart from containers), subclasses aren't as marshal drops them
+"""
+
+_marshal_container_types = frozenset((tuple, list, set, frozenset))
+"""
+Types of containers, which are serialized with marshal if all their items are
+"""
+
+
+def _is_marshallable(value):
+    """
+    Checks whether value consists only of exact builtin types, which marshal serializes without changing them
+
+    :param value: value to be checked
+    :return: whether marshal may be used
+    """
+    value_type = type(value)
+    if value_type in _marshal_types:
+        return True
+    if value_type in _marshal_container_types:
+        return all(_is_marshallable(item) for item in value)
+    if value_type is dict:
+        return all(_is_marshallable(k) and _is_marshallable(v) for k, v in value.items())
+    return False
+
+
+def _dumps(value):
+    """
+    Serializes a value kept in memory, registry values (tuples of sets of field names, strings) are builtin types,
+    so they're serialized with much faster marshal, anything else is pickled
+
+    :param value: value to be serialized
+    :return: bytes with serialized value, prefixed with a byte marking a module used
+    """
+    if _is_marshallable(value):
+        return b'm' + marshal.dumps(value)
+    return b'p' + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(data):
+    """
+    Deserializes a value serialized with _dumps()
+
+    :param data: bytes with serialized value
+    :return: deserialized value
+    """
+    if data[:1] == b'm':
+        return marshal.loads(data[1:])
+    return pickle.loads(data[1:])
 
 
 class PersistentLocMemCache(LocMemCache):
@@ -31,14 +94,138 @@ class PersistentFileBasedCache(FileBasedCache):
     Parameters 'timeout', 'max_entries' and 'cull_frequency' passed to constructor won't have any effect
 
     Do keep in mind that this cache may get really big as it's not limited in size in any way
+
+    Files are read once per process and kept in memory afterwards, while writes update memory immediately
+    and are saved to files by a background thread (every 'FLUSH_INTERVAL' seconds passed in 'OPTIONS',
+    half a second by default) and on process exit. Pending writes of the same key are saved only once.
+    Values are kept serialized, so that (like with files) every get() returns a new copy of a value
+
+    Cache may be shared by many processes, which don't see each other's writes until they write the same key.
+    Values are saved as they are, unless set() got a 'merge' function, which is then applied on save
+    to a value stored in file (possibly written by another process) instead
     """
+    def __init__(self, dir, params):
+        super(PersistentFileBasedCache, self).__init__(dir, params)
+        self._flush_interval = params.get('OPTIONS', {}).get('FLUSH_INTERVAL', 0.5)
+        self._memory = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending_event = threading.Event()
+        self._writer_pid = None
+        atexit.register(self.flush)
+
+    def get(self, key, default=None, version=None):
+        memory_key = self.make_key(key, version)
+        data = self._memory.get(memory_key)
+        if data is None:
+            value = super(PersistentFileBasedCache, self).get(key, _missing, version)
+            data = _missing if value is _missing else _dumps(value)
+            self._memory[memory_key] = data
+        return default if data is _missing else _loads(data)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, merge=None):
+        """
+        Sets value in memory and marks it to be saved
+
+        :param merge: function modifying a value, which is applied on save to a value stored in file instead,
+            if there's any, so that modifications made by many processes aren't lost, value is saved as it is
+            if it was set without merge since last save
+        """
+        memory_key = self.make_key(key, version)
+        data = _dumps(value)
+        with self._lock:
+            self._memory[memory_key] = data
+            _, _, _, merges = self._pending.get(memory_key, (None, None, None, []))
+            merges = merges + [merge] if merge is not None and merges is not None else None
+            self._pending[memory_key] = (key, data, version, merges)
+        self._start_writer()
+        self._pending_event.set()
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Sets all values with a single lock acquisition and wakes writer thread once
+        """
+        pending = {}
+        for key, value in data.items():
+            pending[self.make_key(key, version)] = (key, _dumps(value), version, None)
+        with self._lock:
+            for memory_key, (_, serialized, _, _) in pending.items():
+                self._memory[memory_key] = serialized
+            self._pending.update(pending)
+        self._start_writer()
+        self._pending_event.set()
+
+    def has_key(self, key, version=None):
+        return self.get(key, _missing, version) is not _missing
+
+    def delete(self, key, version=None):
+        memory_key = self.make_key(key, version)
+        self._memory[memory_key] = _missing
+        with self._lock:
+            self._pending.pop(memory_key, None)
+        super(PersistentFileBasedCache, self).delete(key, version)
+
+    def clear(self):
+        self._memory.clear()
+        with self._lock:
+            self._pending.clear()
+        super(PersistentFileBasedCache, self).clear()
+
+    def flush(self):
+        """
+        Saves all pending writes to files, with no expiry time, so that _is_expired() can skip reading it
+
+        Values set with merge functions are built from values stored in files, which may have been written
+        by other processes, such value replaces one in memory, unless it was set again in the meantime
+
+        Flushes are run one at a time, so that flush on process exit waits for the one run by writer thread
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for memory_key, (key, data, version, merges) in pending.items():
+                value = _missing
+                if merges:
+                    value = super(PersistentFileBasedCache, self).get(key, _missing, version)
+                    if value is not _missing:
+                        for merge in merges:
+                            value = merge(value)
+                        with self._lock:
+                            if self._memory.get(memory_key) is data:
+                                self._memory[memory_key] = _dumps(value)
+                if value is _missing:
+                    value = _loads(data)
+                super(PersistentFileBasedCache, self).set(key, value, None, version)
+
+    def _start_writer(self):
+        """
+        Starts a thread saving pending writes, once in every process, as threads don't survive forking
+        """
+        if self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            writer = threading.Thread(target=self._write_pending)
+            writer.daemon = True
+            writer.start()
+
+    def _write_pending(self):
+        while True:
+            self._pending_event.wait()
+            time.sleep(self._flush_interval)
+            self._pending_event.clear()
+            self.flush()
+
     def _cull(self):
         pass
 
     def _is_expired(self, f):
         """
         Confirms that key has not expired
-        ``pickle.load(f)`` is mirrored from superclass, lack of it breaks file read afterwards
+
+        Files written by flush() start with pickled None, which is compared and skipped without unpickling,
+        for other files ``pickle.load(f)`` is mirrored from superclass, lack of it breaks file read afterwards
         """
-        pickle.load(f)
+        if f.read(len(_never_expires)) != _never_expires:
+            f.seek(0)
+            pickle.load(f)
         return False
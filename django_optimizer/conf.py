@@ -5,22 +5,55 @@ Conf module containing app settings
 import os
 
 import django
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_missing = object()
+
+
+class LazyDefault(object):
+    """
+    Descriptor for a default value of a setting, which depends on project settings and is built on access
+
+    It's resolved once, as DjangoOptimizerSettings caches it like any other setting
+    """
+    def __init__(self, builder):
+        self.builder = builder
+
+    def __get__(self, instance, owner):
+        return self if instance is None else self.builder()
 
 
 class DjangoOptimizerSettings(object):
     """
     Container for settings exclusive for an app, with possibility to replace any in project settings
+
+    Resolved values are cached, as some settings are read for every fetched object, cache is cleared
+    whenever django sends ``setting_changed`` signal
     """
+    __slots__ = ('_cache',)
+
+    def __init__(self):
+        self._cache = {}
+
     def __getattribute__(self, item):
+        cache = super(DjangoOptimizerSettings, self).__getattribute__('_cache')
         try:
-            return getattr(django.conf.settings, item)
-        except AttributeError:
-            return super(DjangoOptimizerSettings, self).__getattribute__(item)
+            return cache[item]
+        except KeyError:
+            value = getattr(django.conf.settings, item, _missing)
+            if value is _missing:
+                value = super(DjangoOptimizerSettings, self).__getattribute__(item)
+            cache[item] = value
+            return value
+
+    def clear_cache(self):
+        super(DjangoOptimizerSettings, self).__getattribute__('_cache').clear()
 
-    DJANGO_OPTIMIZER_FIELD_REGISTRY = {
+    DJANGO_OPTIMIZER_FIELD_REGISTRY = LazyDefault(lambda: {
         'BACKEND': 'django_optimizer.cache.PersistentFileBasedCache',
         'LOCATION': os.path.join(django.conf.settings.BASE_DIR, '.django_optimizer_field_registry')
-    }
+    })
     """
     Cache to be used in field registry (which contains tuples of fields gathered and used to optimize queries)
     
@@ -33,10 +66,10 @@ class DjangoOptimizerSettings(object):
     If performance issues occur, then it should be dropped in favor of manual in-code optimization (at least partially)
     """
 
-    DJANGO_OPTIMIZER_CODE_REGISTRY = {
+    DJANGO_OPTIMIZER_CODE_REGISTRY = LazyDefault(lambda: {
         'BACKEND': 'django_optimizer.cache.PersistentFileBasedCache',
         'LOCATION': os.path.join(django.conf.settings.BASE_DIR, '.django_optimizer_code_registry')
-    }
+    })
     """
     Cache to be used in code registry (which contains code annotations for source code)
     
@@ -49,6 +82,21 @@ class DjangoOptimizerSettings(object):
     Name of a PersistentLocMemCache holding objects to be created after deferred_atomic block
     """
 
+    DJANGO_OPTIMIZER_DEFERRED_BATCH_SIZE = 500
+    """
+    Maximum number of objects inserted or updated in a single query after deferred_atomic block
+
+    Keeps sizes of sql queries bounded when many objects are saved, might be set to None to use a single query
+    """
+
+    DJANGO_OPTIMIZER_DEFERRED_FLUSH_THRESHOLD = None
+    """
+    Number of pending objects of a model, at which they are saved before the end of deferred_atomic block
+
+    Bounds memory used by long blocks, queries are still run inside of the block's transaction
+    Disabled with None by default, so that all objects are saved on exit of the block
+    """
+
     DJANGO_OPTIMIZER_LOGGING = True
     """
     Whether model logging should be enabled
@@ -75,3 +123,8 @@ class DjangoOptimizerSettings(object):
 
 
 settings = DjangoOptimizerSettings()
+
+
+@receiver(setting_changed)
+def clear_settings_cache(**kwargs):
+    settings.clear_cache()
@@ -14,27 +14,48 @@ class LoggingIterable(object):
     gathering column data and identifying relevant queryset
 
     Needs to be added to every Iterable class to make sure every object has these attributes
+
+    Way of passing this data depends on rows yielded by an Iterable class, so it's chosen by subclasses
+    in _log_rows() instead of being checked for every object. Rows that can't hold it are yielded as they are
     """
     def __iter__(self):
-        from django_optimizer.wrappers import logging_model_wrapper
+        rows = super(LoggingIterable, self).__iter__()
+        if not settings.DJANGO_OPTIMIZER_LOGGING:
+            return rows
+        return self._log_rows(rows)
 
-        for obj in super(LoggingIterable, self).__iter__():
-            if not settings.DJANGO_OPTIMIZER_LOGGING:
-                yield obj
-            else:
-                try:
-                    obj._queryset = self.queryset
-                except AttributeError:
-                    obj['_queryset'] = self.queryset
-                yield logging_model_wrapper(obj)
+    def _log_rows(self, rows):
+        return rows
 
 
 class LoggingModelIterable(LoggingIterable, ModelIterable):
-    pass
+    def _log_rows(self, rows):
+        from django_optimizer.monkey_patching import patch_getattribute
+        from django_optimizer.wrappers import get_logging_model_wrapper
+
+        # lookups don't change after queryset gets evaluated, so they are gathered once, not on each relation access
+        queryset = self.queryset
+        queryset._prefetch_lookup_names = queryset._get_prefetch_lookup_names()
+        # field usage in instances is logged by wrapped descriptors, except fields which may be later passed to only()
+        # these are gathered only when registry doesn't have them
+        if queryset._without_only:
+            patch_getattribute(queryset.model)
+            logging_model_wrapper = get_logging_model_wrapper(queryset.model)
+            for obj in rows:
+                obj._queryset = queryset
+                yield logging_model_wrapper(obj)
+        else:
+            for obj in rows:
+                obj._queryset = queryset
+                yield obj
 
 
 class LoggingValuesIterable(LoggingIterable, ValuesIterable):
-    pass
+    def _log_rows(self, rows):
+        queryset = self.queryset
+        for row in rows:
+            row['_queryset'] = queryset
+            yield row
 
 
 class LoggingValuesListIterable(LoggingIterable, ValuesListIterable):
@@ -2,15 +2,40 @@
 """
 Location module containing ObjectLocation definition
 """
-import inspect
+import sys
 
 from django.conf import settings as django_settings
+from django.utils.six.moves import intern
+
+
+def _intern(string):
+    """
+    Interns a string, strings that can't be interned (unicode on Python 2) are returned as they are
+
+    :param string: string to be interned
+    :return: interned string
+    """
+    return intern(string) if isinstance(string, str) else string
+
+
+_numbered_locations = {}
+"""
+Locations with line numbers, stored by code object and line number of latest source code frame
+and located object's name, as no other data is used to identify these locations
+"""
 
 
 class ObjectLocation(object):
     """
     Class for storing information about object location
+
+    Instances are created for every queryset, so attributes are kept in slots instead of a dict
+
+    String representation is formatted once, as it's used as a registry key and locations don't change,
+    its parts are interned as they repeat across locations of a project
     """
+    __slots__ = ('source', 'file', 'scope', 'name', 'number', 'string')
+
     def __init__(self, name, with_number):
         """
         Gets values from source code stack frames (file name, function names)
@@ -19,24 +44,35 @@ class ObjectLocation(object):
         :param name: string indicating a type or name for a located object
         :param with_number: whether line number should be considered or not
         """
-        self.source = self.get_source()
+        frame = self.get_frame()
+        key = (frame.f_code, frame.f_lineno, name) if frame is not None and with_number else None
+        if key in _numbered_locations:
+            location = _numbered_locations[key]
+            for attr in self.__slots__:
+                setattr(self, attr, getattr(location, attr))
+            return
+
+        self.source = self.get_source(frame)
         if self.source:
-            self.file = self.get_file()
-            self.scope = self.get_scope()
-            self.name = self.get_name(name)
+            self.file = _intern(self.get_file())
+            self.scope = _intern(self.get_scope())
+            self.name = _intern(self.get_name(name))
             self.number = self.get_number() if with_number else None
+            format_str = '{file}::{name}::{number}' if self.number else '{file}/{scope}/{name}'
+            self.string = format_str.format(file=self.file, scope=self.scope, name=self.name, number=self.number)
+        else:
+            self.string = ''
+
+        if key is not None:
+            _numbered_locations[key] = self
 
     def __str__(self):
         """
-        Joins all fields retrieved in __init__()
+        Returns all fields retrieved and joined in __init__()
 
         :return: string representation, uniqueness wrt filename, execution scope and passed name
         """
-        if self.source:
-            format_str = '{file}::{name}::{number}' if self.number else '{file}/{scope}/{name}'
-            return format_str.format(**self.__dict__)
-        else:
-            return ''
+        return self.string
 
     def __bool__(self):
         """
@@ -47,29 +83,48 @@ class ObjectLocation(object):
         return bool(self.source)
 
     @staticmethod
-    def get_source():
+    def get_frame():
+        """
+        Walks the stack ignoring frames executing libraries' code
+
+        Frames are read directly, as ``inspect.stack()`` reads source code context for every frame on the stack
+
+        :return: latest source code frame existing on traceback or None
+        """
+        base_dir = django_settings.BASE_DIR
+        frame = sys._getframe()
+        while frame is not None and base_dir not in frame.f_code.co_filename:
+            frame = frame.f_back
+        return frame
+
+    @staticmethod
+    def get_source(frame):
         """
-        Gets full stack, then ignores frames executing libraries' code and frames executing code
-        from a file different to last source code frame
+        Walks the stack from latest source code frame, ignoring frames executing code from a different file
 
-        :return: list of frame objects that execute latest file of source code existing on traceback
+        :param frame: latest source code frame received from get_frame()
+        :return: list of (filename, line number, function name) tuples of frames that execute latest file
+            of source code existing on traceback
         """
-        try:
-            latest_file_name = [s[1] for s in inspect.stack() if django_settings.BASE_DIR in s[1]][0]
-            return [s for s in inspect.stack() if s[1] == latest_file_name]
-        except IndexError:
-            return []
+        source = []
+        if frame is not None:
+            latest_file_name = frame.f_code.co_filename
+            while frame is not None:
+                if frame.f_code.co_filename == latest_file_name:
+                    source.append((latest_file_name, frame.f_lineno, frame.f_code.co_name))
+                frame = frame.f_back
+        return source
 
     def get_file(self):
-        _, filename, _, _, _, _ = self.source[0]
+        filename, _, _ = self.source[0]
         return filename.replace(django_settings.BASE_DIR + '/', '')
 
     def get_scope(self):
-        _, filename, _, _, _, _ = self.source[0]
-        return '.'.join(reversed([str(s[3]) for s in self.source if s[1] == filename]))
+        # get_source() keeps frames of one file only, so function names don't need to be filtered again
+        return '.'.join(reversed([function_name for _, _, function_name in self.source]))
 
     def get_number(self):
-        _, _, lineno, _, _, _ = self.source[0]
+        _, lineno, _ = self.source[0]
         return str(lineno)
 
     @staticmethod
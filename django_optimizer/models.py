@@ -1,14 +1,45 @@
+import threading
+import weakref
+
 from django.db import models, router
 from django.db.transaction import get_connection
 
+from django_optimizer.conf import settings
+from django_optimizer.monkey_patching import instance_getattribute
 from django_optimizer.registry import model_registry
-from django_optimizer.transaction import get_db_instance, DeferredPK, DeferredAtomic
+from django_optimizer.transaction import (
+    get_db_instance, perform_deferred_db_queries, DeferredPK, DeferredAtomic, _deferred_instance_refs
+)
+
+
+def _get_refs_remover(model, obj_id):
+    """
+    Gets weak reference callback, which clears references to collected instance from objects in model registry
+
+    Used instead of __del__() in model, which would be run for every instance and prevents collection of instances
+    in reference cycles on Python 2
+
+    Callback may be run by any thread, so thread which saved an instance is remembered to find its objects,
+    references are cleared later, as callback may be run while model registry's cache lock is held
+
+    :param model: model class of deferred instance
+    :param obj_id: id of deferred instance
+    :return: callback function
+    """
+    def remove_refs(ref):
+        _deferred_instance_refs.pop(obj_id, None)
+        model_registry.add_collected_ref(model, obj_id, thread_id)
+    thread_id = threading.current_thread().ident
+    return remove_refs
 
 
 class DeferredModel(models.Model):
     class Meta:
         abstract = True
 
+    # DeferredPK assigned in save() is replaced with pk value on access
+    __getattribute__ = instance_getattribute
+
     def save(self, *args, **kwargs):
         def _get_signal_params(**obj_kwargs):
             return {
@@ -17,7 +48,7 @@ class DeferredModel(models.Model):
                 'created': self._state.adding,
                 'update_fields': obj_kwargs.get('update_fields'),
                 'raw': obj_kwargs.get('raw', False),
-                'using': obj_kwargs.get('using', router.db_for_write(self.__class__, instance=self))
+                'using': obj_kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
             }
 
         def _get_instance_with_duplicate_handling():
@@ -28,11 +59,16 @@ class DeferredModel(models.Model):
         if getattr(get_connection(), DeferredAtomic.connection_attr_name, None) != DeferredAtomic.__name__:
             super(DeferredModel, self).save(*args, **kwargs)
         else:
-            models.signals.pre_save.send(**_get_signal_params(**kwargs))
-            model_registry.add(_get_instance_with_duplicate_handling())
+            # signal parameters aren't built for models without receivers, which is checked from signal's cache
+            if models.signals.pre_save.has_listeners(self.__class__):
+                models.signals.pre_save.send(**_get_signal_params(**kwargs))
+            pending = model_registry.add(_get_instance_with_duplicate_handling())
+            self._deferred_pk = True
+            _deferred_instance_refs[id(self)] = weakref.ref(self, _get_refs_remover(self._meta.model, id(self)))
             setattr(self, self._meta.pk.attname, DeferredPK(self))
-            models.signals.post_save.send(**_get_signal_params(**kwargs))
+            if models.signals.post_save.has_listeners(self.__class__):
+                models.signals.post_save.send(**_get_signal_params(**kwargs))
 
-    def __del__(self):
-        if not hasattr(self, '_deferred_obj'):
-            model_registry.remove_refs(self._meta.model, id(self))
+            flush_threshold = settings.DJANGO_OPTIMIZER_DEFERRED_FLUSH_THRESHOLD
+            if flush_threshold and pending >= flush_threshold:
+                perform_deferred_db_queries(self._meta.model)
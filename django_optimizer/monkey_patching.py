@@ -1,25 +1,86 @@
 # -*- coding: utf-8 -*-
 """
-Monkey patching module needed to overload logging model instance's __getattribute__ method
+Monkey patching module needed to overload __getattribute__ method of logged and deferred model classes,
+to replace field descriptors of every model class with their logging versions
+and to log fields refreshed in model instances
 """
 from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
 
 from django_optimizer.transaction import DeferredPK
+from django_optimizer.wrappers import logging_descriptor_wrapper
 
 
 def deferred_getattribute(self, item):
     val = object.__getattribute__(self, item)
-    if isinstance(val, DeferredPK):
+    # DeferredPK isn't subclassed, so type identity is enough
+    if type(val) is DeferredPK:
         val = val.get_value()
     return val
 
 
 def instance_getattribute(self, key):
-    try:
-        getter = deferred_getattribute(self, 'instance_getattribute')
+    # hook is looked up in instance dict, as probing it with getattr() would raise AttributeError
+    # on every attribute access of every patched model instance that isn't logged
+    data = object.__getattribute__(self, '__dict__')
+    getter = data.get('instance_getattribute')
+    if getter is not None:
         return getter(key)
-    except AttributeError:
+    # DeferredPK is assigned only to instances marked in DeferredModel.save(), others don't need to be checked
+    if '_deferred_pk' in data:
         return deferred_getattribute(self, key)
+    return object.__getattribute__(self, key)
 
 
-models.Model.__getattribute__ = instance_getattribute
+def patch_getattribute(model_class):
+    """
+    Sets instance_getattribute() as __getattribute__ of a model class
+
+    It's set only on classes, which instances are logged or hold DeferredPK, as every attribute access
+    runs it, instances of other model classes keep the default implementation
+
+    :param model_class: model class to be patched
+    """
+    if model_class.__dict__.get('__getattribute__') is not instance_getattribute:
+        model_class.__getattribute__ = instance_getattribute
+
+
+_model_refresh_from_db = models.Model.refresh_from_db
+
+
+def logging_refresh_from_db(self, using=None, fields=None):
+    """
+    Logs fields for only() refreshed in an instance fetched by a logged queryset, set once on Model class
+
+    Only fields missing in an instance dict were deferred by only(), loaded ones are refreshed deliberately.
+    Logging versions of DeferredAttribute log loads of deferred fields on access already, this logs explicit calls
+    """
+    instance_dict = self.__dict__
+    queryset = instance_dict.get('_queryset')
+    if queryset is not None and fields:
+        for field in fields:
+            if field not in instance_dict:
+                queryset._add_only(field)
+    return _model_refresh_from_db(self, using, fields)
+
+
+models.Model.refresh_from_db = logging_refresh_from_db
+
+
+@receiver(class_prepared)
+def add_logging_descriptors(sender, **kwargs):
+    """
+    Wraps descriptors of forward relations and deferred fields defined in prepared model class, once for its lifetime
+
+    DeferredAttribute of a field may be inherited from an abstract model, so it's searched for in whole class
+    """
+    for field in sender._meta.local_fields + sender._meta.local_many_to_many:
+        deferred_attribute = getattr(sender, field.attname, None)
+        if isinstance(deferred_attribute, DeferredAttribute):
+            logging_descriptor_wrapper(deferred_attribute, field)
+
+        descriptor = sender.__dict__.get(field.name)
+        if field.is_relation and descriptor is not None:
+            logging_descriptor_wrapper(descriptor, field)
@@ -5,11 +5,35 @@ Query module - SelectiveQuerySet and DeferredQuerySet definition
 from django.db import models
 from django.db.models import Prefetch
 from django.db.models.query import ModelIterable
+from django.utils.functional import cached_property
 
 from django_optimizer.conf import settings
 from django_optimizer.iterables import LoggingModelIterable, LoggingValuesIterable, LoggingValuesListIterable
 from django_optimizer.location import ObjectLocation
-from django_optimizer.registry import field_registry, code_registry
+from django_optimizer.registry import FieldRegistry, field_registry, code_registry
+
+_prefetch_fields = {}
+"""
+Names and related models of fields used in prefetch_related(), stored by model class and label from registry
+"""
+
+
+def _get_prefetch_field(model, label):
+    """
+    Gets field name and model of objects to prefetch on given label, computed once for the process lifetime
+
+    :param model: model class of optimized queryset
+    :param label: field name from registry
+    :return: field name and model class to use in Prefetch object
+    """
+    key = (model, label)
+    try:
+        return _prefetch_fields[key]
+    except KeyError:
+        field = model._meta.get_field(label)
+        related_model = field.model if model != field.model else field.related_model
+        _prefetch_fields[key] = field.name, related_model
+        return field.name, related_model
 
 
 class LoggingPrefetch(Prefetch):
@@ -36,15 +60,40 @@ class SelectiveQuerySet(models.query.QuerySet):
     """
 
     def __init__(self, *args, **kwargs):
-        """
-        Remembers its location, which is set in __init__() function of ObjectLocation class
-        """
         super(SelectiveQuerySet, self).__init__(*args, **kwargs)
         self._live_optimization = settings.DJANGO_OPTIMIZER_LIVE_OPTIMIZATION
         self._offsite_optimization = settings.DJANGO_OPTIMIZER_OFFSITE_OPTIMIZATION
-        self._location = ObjectLocation(self.model.__name__, self._offsite_optimization)
-        self._registry_fields = field_registry.get(self._location)
-        self._without_only = not self._registry_fields[field_registry.ONLY]
+
+    @cached_property
+    def _location(self):
+        """
+        Remembers its location, which is set in __init__() function of ObjectLocation class
+
+        It's retrieved on first use instead of in __init__(), as clones inherit it in _clone()
+        and stack walk is needed only once for every queryset created by a manager
+        """
+        return ObjectLocation(self.model.__name__, self._offsite_optimization)
+
+    @cached_property
+    def _registry_fields(self):
+        return field_registry.get(self._location)
+
+    @cached_property
+    def _without_only(self):
+        return not self._registry_fields[FieldRegistry.ONLY]
+
+    def _clone(self, **kwargs):
+        """
+        Passes location and field sets retrieved from registry to a clone, so that they are not retrieved again
+
+        They're passed only if already retrieved, as reading properties here would retrieve them
+        for every clone, also for ones that are never evaluated
+        """
+        clone = super(SelectiveQuerySet, self)._clone(**kwargs)
+        for attr in ('_location', '_registry_fields'):
+            if attr in self.__dict__:
+                clone.__dict__[attr] = self.__dict__[attr]
+        return clone
 
     def _fetch_all(self):
         """
@@ -87,10 +136,18 @@ class SelectiveQuerySet(models.query.QuerySet):
         # should be a noop if object is outside of QuerySet
         # in case of _fetch_all() _optimize() is expected to be called once, before self._result_cache field creation
         # in case of values(_list), _optimize() will be manually called before them and skipped later
-        if self._location and self._result_cache is None and self._fields is None:
+        # location is checked last, as it's retrieved on first access
+        if self._result_cache is None and self._fields is None and self._location:
             if self._live_optimization:
-                qs = self._prepare_qs(*self._registry_fields)
-                self.__dict__.update(qs.__dict__)
+                # there's nothing to optimize before any fields were gathered, so queryset isn't cloned then
+                if any(self._registry_fields):
+                    # optimizations change only the query and prefetch lookups of a clone
+                    qs = self._prepare_qs(*self._registry_fields)
+                    self.query = qs.query
+                    self._prefetch_related_lookups = qs._prefetch_related_lookups
+                else:
+                    # nullable fields selected by a programmer are still removed from querysets locking rows
+                    self._filter_nullable_select_related()
                 if self._offsite_optimization:
                     self._log_qs()
 
@@ -133,7 +190,11 @@ class SelectiveQuerySet(models.query.QuerySet):
 
     def _prepare_qs(self, select, prefetch, only):
         """
-        Runs only(), select_related() and prefetch_related() on self, based on parameters and returns the result
+        Runs only(), select_related() and prefetch_related() on a clone of self, based on parameters
+        and returns the result
+
+        Queryset is cloned once and modified in place by _perform_*() functions, as each call of select_related(),
+        prefetch_related() and only() would clone it again
 
         Only needs to be last, because it needs to know full list of select_related() fields
 
@@ -142,98 +203,122 @@ class SelectiveQuerySet(models.query.QuerySet):
         :param only: field names to use with only()
         :return: final queryset object
         """
-        return self._perform_select_related(select)._perform_prefetch_related(prefetch)._perform_only(only)
+        return self._clone()._perform_select_related(select)._perform_prefetch_related(prefetch)._perform_only(only)
 
     def _perform_select_related(self, fields):
-        qs = self
-
         # if user deliberately wants to select all fields, then it shouldn't be optimized
         if self.query.select_related is True:
-            return qs
+            return self
 
         # if there are no fields, select_related() shouldn't be called at all
         # passing None clears the list (and selects added manually by a programmer)
         # passing empty list turns on select on all fields (opposite to this case)
-        if fields:
-            qs = qs.select_related(*fields)
+        # fields already selected by a programmer don't need to be added again
+        select_fields = self.query.select_related
+        if fields and not (isinstance(select_fields, dict) and fields.issubset(select_fields)):
+            self.query.add_select_related(fields)
 
+        return self._filter_nullable_select_related()
+
+    def _filter_nullable_select_related(self):
         # select_for_update doesn't support select_related on nullable field at least for PostgreSQL
         # select fields are checked and removed if they're nullable to prevent errors
-        if qs.select_for_update and not isinstance(qs.query.select_related, bool):
+        if self.query.select_for_update and not isinstance(self.query.select_related, bool):
             def _filter_nullable_fields(model, field_dict):
-                new_dict = dict()
-                for key, value in field_dict.iteritems():
-                    field = model._meta.get_field(key)
-                    if not field.null:
-                        new_dict[key] = _filter_nullable_fields(field.related_model, value)
-                return new_dict
-
-            qs.query.select_related = _filter_nullable_fields(qs.model, qs.query.select_related)
-
-        return qs
+                # nested dicts are walked with a stack instead of recursion
+                filtered_dict = dict()
+                stack = [(model, field_dict, filtered_dict)]
+                while stack:
+                    model, field_dict, new_dict = stack.pop()
+                    for key, value in field_dict.items():
+                        field = model._meta.get_field(key)
+                        if not field.null:
+                            new_dict[key] = dict()
+                            stack.append((field.related_model, value, new_dict[key]))
+                return filtered_dict
+
+            self.query.select_related = _filter_nullable_fields(self.model, self.query.select_related)
+
+        return self
 
     def _perform_prefetch_related(self, fields):
         from django_optimizer.wrappers import selective_query_set_wrapper
 
-        qs = self
-
         # for all labels Prefetch object gets created with dynamically mixined queryset
         # used to enable optimization of these querysets in prefetch objects
         # without field queryset being declared as optimized in models
+        # lookups are gathered once, as labels added in this loop are unique and aren't checked again
+        prefetch_lookups = self._get_prefetch_lookup_names()
+        prefetch_objs = []
         for label in fields:
-            prefetch_lookups = [
-                getattr(lookup, 'prefetch_through', str(lookup)) for lookup in self._prefetch_related_lookups
-            ]
             if label not in prefetch_lookups:
-                field = self.model._meta.get_field(label)
-                model = field.model if self.model != field.model else field.related_model
+                name, model = _get_prefetch_field(self.model, label)
                 queryset = selective_query_set_wrapper(model)
-                prefetch_obj = LoggingPrefetch(field.name, queryset=queryset)
-                qs = qs.prefetch_related(prefetch_obj)
+                prefetch_objs.append(LoggingPrefetch(name, queryset=queryset))
 
-        return qs
+        # lookups are kept in a list before Django 1.11 and in a tuple since then
+        if prefetch_objs:
+            self._prefetch_related_lookups += type(self._prefetch_related_lookups)(prefetch_objs)
 
-    def _perform_only(self, fields):
-        qs = self
+        return self
+
+    def _get_prefetch_lookup_names(self):
+        """
+        Gets names of lookups passed to prefetch_related() so far
 
+        Checks for Prefetch objects explicitly, as getattr() with default would evaluate str(lookup) every time
+
+        :return: frozenset of lookup names from strings and Prefetch objects, as it's used only in membership tests
+        """
+        return frozenset(
+            lookup.prefetch_through if isinstance(lookup, Prefetch) else lookup
+            for lookup in self._prefetch_related_lookups
+        )
+
+    def _perform_only(self, fields):
         # first evaluation of a queryset skips only for performance reasons (.only('id') was painfully slow)
         # instead on first evaluation most common fields are gathered even if they exist in an object
         # every evaluation after that will consider whether field exist or not prior to adding it to fields
         if not fields:
-            return qs
+            return self
 
         # if only doesn't have fields specified previously in select_related, then InvalidQuery error is raised
         # this needs to be taken care of here, fields have to contain contents of select_related field in query
         # that's why only() is executed last - this takes into account select fields added in _perform_select_related()
+        # registry sets are shared, so fields are gathered in a single local set built from a copy
+        only_fields = set(fields)
         select_fields = self.query.select_related
         if not isinstance(select_fields, bool):
-            fields |= set(select_fields.keys())
+            only_fields.update(select_fields)
 
         # here previous manual only() and defer() invocations are taken into consideration
         # it's essential to have refresh_from_db() work correctly as it uses only() with own fields and default_manager
         # lack of it resulted in refresh_from_db() being unable to refetch field deferred by _perform_only
         initial_fields, defer = self.query.deferred_loading
         if defer:
-            fields -= initial_fields
+            only_fields.difference_update(initial_fields)
         else:
-            fields |= initial_fields
+            only_fields.update(initial_fields)
+            # previous only() already loads all these fields
+            if only_fields == initial_fields:
+                return self
 
-        qs = qs.only(*fields)
+        self.query.add_immediate_loading(only_fields)
 
-        return qs
+        return self
 
     def _add_field(self, field, index):
         if field not in self._registry_fields[index]:
             self._registry_fields = field_registry.add(self._location, index, field)
 
     def _add_select(self, field):
-        self._add_field(field, field_registry.SELECT)
+        self._add_field(field, FieldRegistry.SELECT)
 
     def _add_prefetch(self, field):
-        self._add_field(field, field_registry.PREFETCH)
+        self._add_field(field, FieldRegistry.PREFETCH)
 
     def _add_only(self, field):
-        self._add_field(field, field_registry.ONLY)
+        self._add_field(field, FieldRegistry.ONLY)
 
 
 class DeferredQuerySet(models.query.QuerySet):
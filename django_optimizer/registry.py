@@ -6,28 +6,46 @@ Contains a definition of a FieldRegistry - object containing information
 about field names required to optimize querysets
 """
 import ast
-import copy
 import csv
+import json
+import threading
 
 from django.conf import settings as django_settings
-from django.forms.models import model_to_dict
+from django.utils.functional import SimpleLazyObject
 from django.utils.module_loading import import_string
+from django.utils.six.moves import intern
 
+from django_optimizer.cache import PersistentFileBasedCache
 from django_optimizer.conf import settings
 
+CSV_BUFFER_SIZE = 1024 * 1024
+"""
+Size of a buffer used in file reads and writes when converting registry from and to csv
+"""
+
+FIELD_NAMES_SEPARATOR = '|'
+"""
+Separator of field names in a single column of field registry's csv file
+"""
+
+_missing = object()
+
 
 class Registry(object):
-    def __init__(self, cache_settings, initial_value, key_list_id):
+    def __init__(self, cache_settings, initial_value_factory, key_list_id):
         """
         Gets registry wrapping cache object with key management and csv conversion enabled
 
         :param cache_settings: parameters passed to cache
-        :param initial_value: empty value in cache
+        :param initial_value_factory: function returning empty value in cache, called instead of copying a value
         :param key_list_id: unique id for key list
         """
         self.cache = self._get_cache(cache_settings)
-        self.initial_value = initial_value
+        self.initial_value_factory = initial_value_factory
         self.key_list_id = key_list_id
+        self._keys = None
+        # registries are shared by all threads, read-modify-write operations on cache are done under this lock
+        self._lock = threading.RLock()
 
     @staticmethod
     def _get_cache(cache_params):
@@ -37,31 +55,75 @@ class Registry(object):
         :param cache_params: parameters passed to cache including required 'BACKEND' and 'LOCATION' settings
         :return: cache object for registry
         """
-        params = copy.deepcopy(cache_params)
+        # only top-level keys are popped, so a shallow copy is enough
+        params = dict(cache_params)
         backend = params.pop('BACKEND')
         location = params.pop('LOCATION', '')
         backend_cls = import_string(backend)
         return backend_cls(location, params)
 
+    def _get_key_set(self):
+        """
+        Gets a set of key names, read from cache once and replaced on every write of key set afterwards
+
+        Key names are checked on every write to registry, so they aren't deserialized from cache every time
+
+        :return: set of key names
+        """
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    # key names are stored as a set, caches written by previous versions may still hold a list
+                    self._keys = set(self.cache.get(self.key_list_id) or ())
+        return self._keys
+
     def has_key(self, key):
         """
         Checks whether given key has been added before
-        
+
         :param key: key to be checked
         :return: whether key exists in field
         """
-        key_list = self.get_keys()
-        return key in key_list
+        return key in self._get_key_set()
+
+    def _update_key_set(self, modifier):
+        """
+        Writes key set modified by passed function, applied to a set read again from cache,
+        as keys may have been added or removed by other processes sharing cache since it was read
+
+        :param modifier: function to be used with key set retrieved from cache, which returns a new set
+        """
+        def modify(keys):
+            # key names are stored as a set, caches written by previous versions may still hold a list
+            return modifier(set(keys or ()))
+
+        with self._lock:
+            key_set = modify(self.cache.get(self.key_list_id))
+            self._write(self.key_list_id, key_set, modify)
+            self._keys = key_set
+
+    def _write(self, key, value, modifier):
+        """
+        Writes value to cache, PersistentFileBasedCache also gets a modifier, which it applies on save
+        to a value stored by other processes sharing its files, instead of writing this value
+
+        :param key: cache key
+        :param value: modified value
+        :param modifier: function which returned modified value
+        """
+        if isinstance(self.cache, PersistentFileBasedCache):
+            self.cache.set(key, value, merge=modifier)
+        else:
+            self.cache.set(key, value)
 
     def add_key(self, key):
         """
-        Adds a key name to separate cache field
+        Adds a key name to separate cache field, which is written only if key wasn't added before
 
         :param key: key to be added
         """
-        key_list = self.get_keys()
-        key_list.append(key)
-        self.cache.set(self.key_list_id, key_list)
+        if key not in self._get_key_set():
+            self._update_key_set(lambda keys: keys | {key})
 
     def remove_key(self, key):
         """
@@ -69,9 +131,7 @@ class Registry(object):
 
         :param key: key to be removed
         """
-        key_list = self.get_keys()
-        key_list.remove(key)
-        self.cache.set(self.key_list_id, key_list)
+        self._update_key_set(lambda keys: keys - {key})
 
     def get_keys(self):
         """
@@ -80,9 +140,21 @@ class Registry(object):
         They may be later used on listing all entries or dumping cache to csv
         as most caches don't have a way of getting all pairs
 
+        Key names are read again from cache, so that keys added by other processes are listed too
+
         :return: set of key names
         """
-        return self.cache.get(self.key_list_id) or []
+        with self._lock:
+            self._keys = set(self.cache.get(self.key_list_id) or ())
+            return set(self._keys)
+
+    def clear(self):
+        """
+        Clears registry's cache together with key names
+        """
+        with self._lock:
+            self.cache.clear()
+            self._keys = set()
 
     def get(self, key):
         """
@@ -90,10 +162,22 @@ class Registry(object):
 
         If cache didn't have value for this location, returns an initial value
 
+        Value is compared to a sentinel, so that empty values stored in cache are returned as they are
+
         :param key: any object, which str method defines cache key
         :return: value received from registry cache or init value
         """
-        return self.cache.get(str(key)) or copy.deepcopy(self.initial_value)
+        return self._read(str(key))
+
+    def _read(self, key):
+        """
+        Reads value from cache, bypassing values kept by subclasses
+
+        :param key: cache key
+        :return: value received from registry cache or init value
+        """
+        value = self.cache.get(key, _missing)
+        return self.initial_value_factory() if value is _missing else value
 
     def set(self, key, modifier):
         """
@@ -101,16 +185,19 @@ class Registry(object):
 
         Adds a key to key set if corresponding value in cache didn't exist
 
+        Modified value is read from cache, not from values kept by subclasses, as other processes
+        sharing cache may have changed it in the meantime
+
         :param key: any object, which str method defines cache key
         :param modifier: function to be used with value retrieved from cache, which returns a new value
         :return: value received from cache and modified by setter
         """
         key = str(key)
-        value = self.get(key)
-        if key not in self.get_keys():
+        with self._lock:
+            value = self._read(key)
             self.add_key(key)
-        value = modifier(value)
-        self.cache.set(key, value)
+            value = modifier(value)
+            self._write(key, value, modifier)
         return value
 
     @staticmethod
@@ -142,13 +229,14 @@ class Registry(object):
         :param clear: whether cache should be cleared before operation
         """
         if clear:
-            self.cache.clear()
-        with open(filepath) as csv_file:
+            self.clear()
+        # values and key names are written to cache at once, after all rows are read
+        with open(filepath, buffering=CSV_BUFFER_SIZE) as csv_file:
             reader = csv.reader(csv_file, delimiter=',')
-            for row in reader:
-                key, val = self.row_to_pair(row)
-                self.add_key(key)
-                self.cache.set(key, val)
+            pairs = dict(self.row_to_pair(row) for row in reader)
+        with self._lock:
+            self._update_key_set(lambda keys: keys | set(pairs))
+            self.cache.set_many(pairs)
 
     def to_csv(self, filepath):
         """
@@ -156,11 +244,9 @@ class Registry(object):
 
         :param filepath: file to write to
         """
-        with open(filepath, mode='w') as csv_file:
+        with open(filepath, mode='w', buffering=CSV_BUFFER_SIZE) as csv_file:
             writer = csv.writer(csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            for key in sorted(self.get_keys()):
-                row = self.pair_to_row(key, self.get(key))
-                writer.writerow(row)
+            writer.writerows(self.pair_to_row(key, self.get(key)) for key in sorted(self.get_keys()))
 
 
 class FieldRegistry(Registry):
@@ -168,6 +254,9 @@ class FieldRegistry(Registry):
     Registry with a cache for storing field sets used to optimize querysets
 
     Holds 3 different sets containing names of fields to be passed to select_related(), prefetch_related() and only()
+
+    Values are read for every created queryset, so they are kept per key for process lifetime
+    and shared between querysets, that's why sets are frozen
     """
     SELECT = 0
     PREFETCH = 1
@@ -176,9 +265,42 @@ class FieldRegistry(Registry):
     def __init__(self):
         super(FieldRegistry, self).__init__(
             cache_settings=settings.DJANGO_OPTIMIZER_FIELD_REGISTRY,
-            initial_value=(set(), set(), set()),
+            initial_value_factory=lambda: (frozenset(), frozenset(), frozenset()),
             key_list_id='__field_registry_key_set'
         )
+        self._values = {}
+
+    def get(self, key):
+        """
+        Gets value kept from previous calls or retrieves it from cache
+
+        :param key: any object, which str method defines cache key
+        :return: tuple of frozen field sets
+        """
+        key = str(key)
+        try:
+            return self._values[key]
+        except KeyError:
+            value = tuple(self._intern_names(s) for s in super(FieldRegistry, self).get(key))
+            self._values[key] = value
+            return value
+
+    def set(self, key, modifier):
+        # sets stored by other processes are merged by modifier, kept value is replaced with the result
+        with self._lock:
+            value = tuple(self._intern_names(s) for s in super(FieldRegistry, self).set(key, modifier))
+            self._values[str(key)] = value
+        return value
+
+    def clear(self):
+        with self._lock:
+            super(FieldRegistry, self).clear()
+            self._values.clear()
+
+    def from_csv(self, filepath, clear=True):
+        # rows replace values in cache also when it isn't cleared
+        self._values.clear()
+        super(FieldRegistry, self).from_csv(filepath, clear)
 
     def add(self, qs_location, index, field):
         """
@@ -189,19 +311,47 @@ class FieldRegistry(Registry):
         :param field: field name to be inserted to one of the sets
         :return: appended tuple from cache
         """
+        key = str(qs_location)
+        value = self.get(key)
+        if field in value[index]:
+            return value
+
+        field = self._intern_names((field,))
         return self.set(
-            qs_location,
-            lambda x: tuple(s | {field} if index == i else s for i, s in enumerate(x))
+            key,
+            lambda x: tuple(s | field if index == i else s for i, s in enumerate(x))
         )
 
+    @staticmethod
+    def _intern_names(names):
+        """
+        Interns field names, as the same names repeat in sets of many keys and are compared with accessed attributes
+
+        Names that can't be interned (unicode on Python 2) are kept as they are
+
+        :param names: iterable of field names
+        :return: frozenset of field names
+        """
+        return frozenset(intern(name) if isinstance(name, str) else name for name in names)
+
     @staticmethod
     def row_to_pair(row):
-        select, prefetch, only = [ast.literal_eval(r) for r in row[1:]]
+        def _parse(names):
+            # field names are written joined with a separator, which can't be a part of a lookup,
+            # files written by previous versions hold json or python literal lists
+            if not names.startswith('['):
+                return names.split(FIELD_NAMES_SEPARATOR) if names else []
+            try:
+                return json.loads(names)
+            except ValueError:
+                return ast.literal_eval(names)
+
+        select, prefetch, only = [_parse(r) for r in row[1:]]
         return row[0], (set(select), set(prefetch), set(only))
 
     @staticmethod
     def pair_to_row(key, value):
-        return [key, list(value[0]), list(value[1]), list(value[2])]
+        return [key] + [FIELD_NAMES_SEPARATOR.join(sorted(names)) for names in value]
 
 
 class CodeRegistry(Registry):
@@ -212,106 +362,219 @@ class CodeRegistry(Registry):
     def __init__(self):
         super(CodeRegistry, self).__init__(
             cache_settings=settings.DJANGO_OPTIMIZER_CODE_REGISTRY,
-            initial_value='',
+            initial_value_factory=str,
             key_list_id='__code_registry_key_set'
         )
+        self._values = {}
 
     def add(self, qs_location, value):
         """
         Overwrites value in cache
 
+        Code is generated on every evaluation of an optimized queryset, so values added before are kept
+        and cache is written only when code changes
+
         :param qs_location: queryset's ObjectLocation object defining cache key
         :param value: value to be inserted
         """
-        self.set(qs_location, lambda x: value)
+        key = str(qs_location)
+        if self._values.get(key) != value:
+            with self._lock:
+                self.set(key, lambda x: value)
+                self._values[key] = value
+
+    def clear(self):
+        with self._lock:
+            super(CodeRegistry, self).clear()
+            self._values.clear()
+
+    def from_csv(self, filepath, clear=True):
+        # rows replace values in cache also when it isn't cleared
+        self._values.clear()
+        super(CodeRegistry, self).from_csv(filepath, clear)
 
     def apply_to_code(self):
         """
         Applies saved optimizations to source code, adding code that results in optimization of queries
         """
+        # edits are grouped by file, so that every file is read and rewritten once
+        edits = {}
         for key in sorted(self.get_keys()):
             if '::' in key:
                 file_path, name, number = key.split('::')
-                index = int(number) - 1
-                with open('{}/{}'.format(django_settings.BASE_DIR, file_path), mode='r+') as code_file:
-                    contents = code_file.readlines()
+                edits.setdefault(file_path, []).append((int(number) - 1, name, self.get(key)))
+
+        for file_path, file_edits in edits.items():
+            with open('{}/{}'.format(django_settings.BASE_DIR, file_path), mode='r+') as code_file:
+                contents = code_file.read().splitlines(True)
+                for index, name, value in file_edits:
                     contents[index] = '{line}  # django_optimizer ({name}): {value}\n'.format(
-                        line=contents[index][:-1], name=name, value=self.get(key)
+                        line=contents[index].rstrip('\r\n'), name=name, value=value
                     )
-                    code_file.seek(0)
-                    code_file.writelines(contents)
+                code_file.seek(0)
+                code_file.truncate()
+                code_file.write(''.join(contents))
 
 
 class ModelRegistry(Registry):
+    """
+    Registry with a cache for storing objects, which saves were deferred
+
+    Objects of every model are kept in 2 lists, containing objects to be created and to be updated,
+    which are chosen on insertion, so that they don't have to be split when queries are performed
+    """
+    CREATE = 0
+    UPDATE = 1
+
     def __init__(self):
         super(ModelRegistry, self).__init__(
             cache_settings={
                 'BACKEND': 'django_optimizer.cache.PersistentLocMemCache',
                 'LOCATION': settings.DJANGO_OPTIMIZER_MODEL_REGISTRY_LOCATION
             },
-            initial_value=[],
+            initial_value_factory=lambda: ([], []),
             key_list_id='__model_registry_key_set'
         )
+        self._collected_refs = []
 
     @staticmethod
-    def get_key_from_model(model):
-        return '{module}.{name}'.format(module=model.__module__, name=model.__name__) if model else None
+    def get_key_from_model(model, thread_id=None):
+        """
+        Gets a key holding objects of a model saved by a thread
 
-    def add(self, obj):
-        self.set(
-            self.get_key_from_model(obj._meta.model),
-            lambda x: x + [obj]
+        Registry is shared by all threads of a process, while every thread writes objects on exit
+        of its own deferred_atomic block, in its own transaction, so objects are kept separately
+
+        :param model: model class
+        :param thread_id: identifier of a thread, which saved objects, current one by default
+        :return: cache key
+        """
+        if not model:
+            return None
+        return '{thread}:{module}.{name}'.format(
+            thread=threading.current_thread().ident if thread_id is None else thread_id,
+            module=model.__module__,
+            name=model.__name__
         )
 
+    @staticmethod
+    def get_model_from_key(key):
+        return import_string(key.split(':', 1)[1])
+
+    @staticmethod
+    def get_signature(obj):
+        """
+        Gets values of concrete fields of an object, without its pk, used to find its copy in registry
+
+        Values are taken from instance dict, as reading pk (which may hold DeferredPK) or many-to-many fields
+        (which read pk) of deferred instance would insert it immediately
+
+        :param obj: model instance
+        :return: dict of values by field attnames
+        """
+        data = obj.__dict__
+        return {f.attname: data.get(f.attname) for f in obj._meta.concrete_fields if not f.primary_key}
+
+    def add(self, obj):
+        # objects in registry aren't changed apart from their references, so signature used in delete()
+        # is computed once on insertion instead of on every comparison
+        obj._signature = self.get_signature(obj)
+
+        def append(buckets):
+            buckets[self.CREATE if obj._state.adding else self.UPDATE].append(obj)
+            return buckets
+
+        buckets = self.set(self.get_key_from_model(obj._meta.model), append)
+        return sum(len(objects) for objects in buckets)
+
     def delete(self, obj):
-        def filter_out(n, function, iterable):
-            for item in iterable:
-                if function(item) and n > 0:
-                    n -= 1
-                else:
-                    yield item
-
-        def same_dict_with(given):
-            def inner(compared):
-                return model_to_dict(given, exclude='id') == model_to_dict(compared, exclude='id')
-            return inner
-
-        self.set(
-            self.get_key_from_model(obj._meta.model),
-            lambda x: list(filter_out(1, same_dict_with(obj), x))
-        )
+        # lists received from cache are copies, so they are modified in place
+        signature = self.get_signature(obj)
+
+        def delete_first_same(buckets):
+            for objects in buckets:
+                for i, compared in enumerate(objects):
+                    if compared._signature == signature:
+                        del objects[i]
+                        return buckets
+            return buckets
+
+        self.set(self.get_key_from_model(obj._meta.model), delete_first_same)
 
     def delete_by_ref(self, model, obj_id):
-        self.set(
-            self.get_key_from_model(model),
-            lambda x: list(filter(lambda o: o._deferred_obj != obj_id, x))
-        )
+        self.remove_collected_refs()
 
-    def remove_refs(self, model, obj_id):
-        def _clear_ref(ref):
-            def inner(obj):
-                if obj._deferred_obj == ref:
-                    obj._deferred_obj = None
-                return obj
-            return inner
-
-        self.set(
-            self.get_key_from_model(model),
-            lambda x: list(map(_clear_ref(obj_id), x))
-        )
+        def delete_referenced(buckets):
+            for objects in buckets:
+                objects[:] = [o for o in objects if o._deferred_obj != obj_id]
+            return buckets
+
+        self.set(self.get_key_from_model(model), delete_referenced)
+
+    def remove_refs(self, model, obj_id, thread_id=None):
+        def clear_refs(buckets):
+            for objects in buckets:
+                for obj in objects:
+                    if obj._deferred_obj == obj_id:
+                        obj._deferred_obj = None
+            return buckets
+
+        # objects may be already saved, then key isn't added back with empty lists
+        key = self.get_key_from_model(model, thread_id)
+        if self.has_key(key):
+            self.set(key, clear_refs)
+
+    def add_collected_ref(self, model, obj_id, thread_id):
+        """
+        Marks references to collected instance to be cleared from objects before registry is used next time
+
+        It's called by weakref callbacks, which garbage collector runs at any point, also while cache lock is held
+        by the same thread, so cache can't be read or written here
+
+        :param model: model class of collected instance
+        :param obj_id: id of collected instance
+        :param thread_id: identifier of a thread, which saved an instance
+        """
+        self._collected_refs.append((model, obj_id, thread_id))
+
+    def remove_collected_refs(self):
+        """
+        Clears references to collected instances, so that instances created later with the same ids
+        aren't mistaken for them
+        """
+        while self._collected_refs:
+            self.remove_refs(*self._collected_refs.pop())
+
+    def get_thread_keys(self):
+        """
+        Gets keys of objects saved by current thread, objects of other threads are written by their own blocks
+
+        :return: set of keys
+        """
+        prefix = '{}:'.format(threading.current_thread().ident)
+        return {key for key in self.get_keys() if key.startswith(prefix)}
+
+    def get_pairs(self, keys):
+        """
+        Gets objects kept on given keys, which are left in registry until they're removed with remove()
 
-    def pop_pair(self, key):
-        cache = [(import_string(key), self.get(key))]
-        self.remove_key(key)
-        self.cache.delete(key)
-        return cache
+        :param keys: iterable of keys
+        :return: list of model and objects pairs
+        """
+        return [(self.get_model_from_key(key), self.get(key)) for key in keys]
 
-    def pop_all(self):
-        cache = [(import_string(key), self.get(key)) for key in self.get_keys()]
-        self.cache.clear()
-        return cache
+    def remove(self, keys):
+        """
+        Removes objects kept on given keys together with key names
+
+        :param keys: set of keys
+        """
+        with self._lock:
+            self._update_key_set(lambda key_set: key_set - keys)
+            self.cache.delete_many(keys)
 
 
-field_registry = FieldRegistry()
-code_registry = CodeRegistry()
-model_registry = ModelRegistry()
+# registries are created on first use, so that caches aren't instantiated in processes that never use them
+field_registry = SimpleLazyObject(FieldRegistry)
+code_registry = SimpleLazyObject(CodeRegistry)
+model_registry = SimpleLazyObject(ModelRegistry)
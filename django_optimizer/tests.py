@@ -2,6 +2,477 @@
 """
 Tests module
 """
-from django.test import TestCase
+import gc
+import os
+import shutil
+import tempfile
+import threading
 
-# Create your tests here.
+from django.apps import apps
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import IntegrityError, connection, models
+from django.db.models.signals import class_prepared
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six
+from django.utils.safestring import SafeText
+
+from django_optimizer.cache import PersistentFileBasedCache, _dumps
+from django_optimizer.location import ObjectLocation, _numbered_locations
+from django_optimizer.models import DeferredModel
+from django_optimizer.monkey_patching import add_logging_descriptors
+from django_optimizer.query import SelectiveQuerySet
+from django_optimizer.registry import CodeRegistry, FieldRegistry, model_registry
+from django_optimizer.transaction import deferred_atomic
+from django_optimizer.wrappers import LoggingDescriptorMixin, get_logged_field_names
+
+BASE_DIR = os.path.splitext(os.path.abspath(__file__))[0]
+"""
+Project directory used in tests of located querysets, only this module is in it,
+other modules of an app are skipped as library code
+"""
+
+
+class DeferredAuthor(DeferredModel):
+    name = models.CharField(max_length=10)
+
+    class Meta:
+        app_label = 'django_optimizer'
+
+
+class DeferredBook(DeferredModel):
+    title = models.CharField(max_length=10)
+    author = models.ForeignKey(DeferredAuthor, models.CASCADE, related_name='books')
+    editor = models.ForeignKey(DeferredAuthor, models.SET_NULL, null=True, related_name='edited_books')
+
+    class Meta:
+        app_label = 'django_optimizer'
+
+
+class Number(int):
+    """
+    Subclass of a builtin type, which is changed to its base type by marshal
+    """
+
+
+class RecordingQuerySet(object):
+    """
+    Stands in for a queryset, which logged instances were fetched from, recording fields passed to it
+    """
+    def __init__(self):
+        self.select, self.prefetch, self.only = set(), set(), set()
+        self._prefetch_lookup_names = frozenset()
+
+    def _add_select(self, field):
+        self.select.add(field)
+
+    def _add_prefetch(self, field):
+        self.prefetch.add(field)
+
+    def _add_only(self, field):
+        self.only.add(field)
+
+
+class LoggingTestCase(TestCase):
+    def test_descriptors_of_models_prepared_before_app_are_wrapped(self):
+        class_prepared.disconnect(add_logging_descriptors)
+        try:
+            model = type(str('EarlyModel'), (models.Model,), {
+                'author': models.ForeignKey(DeferredAuthor, models.CASCADE),
+                '__module__': __name__,
+                'Meta': type(str('Meta'), (object,), {'app_label': 'django_optimizer'})
+            })
+        finally:
+            class_prepared.connect(add_logging_descriptors)
+        self.assertNotIsInstance(model.__dict__['author'], LoggingDescriptorMixin)
+
+        apps.get_app_config('django_optimizer').ready()
+        self.assertIsInstance(model.__dict__['author'], LoggingDescriptorMixin)
+
+    def test_refresh_from_db_logs_only_deferred_fields(self):
+        DeferredAuthor.objects.create(name='name')
+        author = DeferredAuthor.objects.only('id').get()
+        author._queryset = queryset = RecordingQuerySet()
+        author.refresh_from_db(fields=['id', 'name'])
+
+        self.assertEqual(queryset.only, {'name'})
+
+    def test_related_descriptor_logs_select_of_fields_not_selected(self):
+        author = DeferredAuthor.objects.create(name='name')
+        DeferredBook.objects.create(title='title', author=author)
+
+        book = DeferredBook.objects.get()
+        book._queryset = queryset = RecordingQuerySet()
+        book.author
+        self.assertEqual(queryset.select, {'author'})
+
+        book = DeferredBook.objects.select_related('author').get()
+        book._queryset = queryset = RecordingQuerySet()
+        book.author
+        self.assertEqual(queryset.select, set())
+
+    def test_deferred_attribute_logs_only(self):
+        DeferredAuthor.objects.create(name='name')
+        author = DeferredAuthor.objects.only('id').get()
+        author._queryset = queryset = RecordingQuerySet()
+        author.id
+        self.assertEqual(queryset.only, set())
+
+        author.name
+        self.assertEqual(queryset.only, {'name'})
+
+    def test_logged_field_names(self):
+        self.assertEqual(
+            get_logged_field_names(DeferredBook),
+            {'title', 'author', 'author_id', 'editor', 'editor_id'}
+        )
+        self.assertIs(get_logged_field_names(DeferredBook), get_logged_field_names(DeferredBook))
+
+
+class DeferredAtomicTestCase(TestCase):
+    @override_settings(DJANGO_OPTIMIZER_DEFERRED_FLUSH_THRESHOLD=2)
+    def test_pk_of_flushed_instance_is_not_inserted_again(self):
+        with deferred_atomic():
+            authors = [DeferredAuthor(name='n{}'.format(i)) for i in range(3)]
+            for author in authors:
+                author.save()
+            first_pk = authors[0].pk
+
+        self.assertEqual(sorted(DeferredAuthor.objects.values_list('name', flat=True)), ['n0', 'n1', 'n2'])
+        self.assertEqual(DeferredAuthor.objects.get(pk=first_pk).name, 'n0')
+
+    @override_settings(DJANGO_OPTIMIZER_DEFERRED_FLUSH_THRESHOLD=2)
+    def test_pk_of_flushed_instances_with_same_values_is_not_guessed(self):
+        with deferred_atomic():
+            authors = [DeferredAuthor(name='same') for _ in range(2)]
+            for author in authors:
+                author.save()
+            with self.assertRaises(DeferredAuthor.MultipleObjectsReturned):
+                authors[0].pk
+
+    def test_pk_of_instance_inserted_on_access_is_the_latest_one(self):
+        existing = DeferredAuthor.objects.create(name='same')
+        with deferred_atomic():
+            author = DeferredAuthor(name='same')
+            author.save()
+            pk = author.pk
+
+        self.assertEqual(sorted(DeferredAuthor.objects.values_list('pk', flat=True)), [existing.pk, pk])
+
+    @override_settings(DJANGO_OPTIMIZER_DEFERRED_BATCH_SIZE=2)
+    def test_objects_are_inserted_in_batches(self):
+        with CaptureQueriesContext(connection) as context:
+            with deferred_atomic():
+                for i in range(5):
+                    DeferredAuthor(name='n{}'.format(i)).save()
+
+        inserts = [query for query in context.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(DeferredAuthor.objects.count(), 5)
+
+    def test_refs_of_instance_collected_while_cache_is_locked_are_cleared(self):
+        with deferred_atomic():
+            author = DeferredAuthor(name='name')
+            author.save()
+            # garbage collector may run while cache lock is held, e.g. while a value is unpickled
+            with model_registry.cache._lock.writer():
+                del author
+                gc.collect()
+            model_registry.remove_collected_refs()
+            [(_, (to_create, _))] = model_registry.get_pairs(model_registry.get_thread_keys())
+            self.assertIsNone(to_create[0]._deferred_obj)
+
+    def test_objects_are_pending_after_failed_query(self):
+        with self.assertRaises(IntegrityError):
+            with deferred_atomic():
+                DeferredAuthor(name=None).save()
+
+        keys = model_registry.get_thread_keys()
+        self.addCleanup(model_registry.remove, keys)
+        [(model, (to_create, to_update))] = model_registry.get_pairs(keys)
+        self.assertEqual((model, [obj.name for obj in to_create], to_update), (DeferredAuthor, [None], []))
+
+
+class DeferredAtomicTransactionTestCase(TransactionTestCase):
+    @override_settings(DJANGO_OPTIMIZER_DEFERRED_BATCH_SIZE=1)
+    def test_batches_are_written_in_a_single_transaction(self):
+        with self.assertRaises(IntegrityError):
+            with deferred_atomic():
+                DeferredAuthor(name='name').save()
+                DeferredAuthor(name=None).save()
+        self.addCleanup(model_registry.remove, model_registry.get_thread_keys())
+
+        self.assertEqual(DeferredAuthor.objects.count(), 0)
+
+    def test_block_saves_only_objects_of_its_thread(self):
+        saved, finish = threading.Event(), threading.Event()
+
+        def save_in_other_thread():
+            try:
+                with deferred_atomic():
+                    DeferredAuthor(name='other').save()
+                    saved.set()
+                    finish.wait(5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=save_in_other_thread)
+        thread.start()
+        saved.wait(5)
+        with deferred_atomic():
+            DeferredAuthor(name='main').save()
+        names = list(DeferredAuthor.objects.values_list('name', flat=True))
+        finish.set()
+        thread.join()
+
+        self.assertEqual(names, ['main'])
+        self.assertEqual(sorted(DeferredAuthor.objects.values_list('name', flat=True)), ['main', 'other'])
+
+
+@override_settings(DJANGO_OPTIMIZER_FIELD_REGISTRY={
+    'BACKEND': 'django_optimizer.cache.PersistentLocMemCache',
+    'LOCATION': 'django_optimizer_tests_field_registry'
+})
+class FieldRegistryTestCase(SimpleTestCase):
+    def setUp(self):
+        FieldRegistry().clear()
+
+    def test_fields_added_by_other_registry_are_kept(self):
+        first, second = FieldRegistry(), FieldRegistry()
+        first.get('key')
+        second.get('key')
+        first.add('key', FieldRegistry.ONLY, 'name')
+        second.add('key', FieldRegistry.ONLY, 'title')
+
+        self.assertEqual(FieldRegistry().get('key')[FieldRegistry.ONLY], {'name', 'title'})
+
+    def test_keys_added_by_other_registry_are_kept(self):
+        first, second = FieldRegistry(), FieldRegistry()
+        first.has_key('first')
+        second.add('second', FieldRegistry.ONLY, 'name')
+        first.add('first', FieldRegistry.ONLY, 'name')
+        self.assertEqual(FieldRegistry().get_keys(), {'first', 'second'})
+
+        second.remove_key('second')
+        self.assertEqual(first.get_keys(), {'first'})
+
+    def test_clear_drops_kept_values(self):
+        registry = FieldRegistry()
+        registry.add('key', FieldRegistry.ONLY, 'name')
+        registry.clear()
+
+        self.assertEqual(registry.get('key'), (frozenset(), frozenset(), frozenset()))
+
+    def test_csv_round_trip(self):
+        registry = FieldRegistry()
+        registry.add('key', FieldRegistry.SELECT, 'author')
+        registry.add('key', FieldRegistry.ONLY, 'title')
+        registry.add('key', FieldRegistry.ONLY, 'author_id')
+        filepath = self.get_csv_path()
+        registry.to_csv(filepath)
+        with open(filepath) as csv_file:
+            self.assertEqual(csv_file.read(), 'key,author,,author_id|title\r\n')
+
+        registry.from_csv(filepath)
+        self.assertEqual(
+            FieldRegistry().get('key'),
+            (frozenset(['author']), frozenset(), frozenset(['author_id', 'title']))
+        )
+
+    def test_csv_written_by_previous_versions_is_read(self):
+        filepath = self.get_csv_path()
+        with open(filepath, 'w') as csv_file:
+            csv_file.write('json,"[""author""]",[],"[""author_id"", ""title""]"\r\n')
+            csv_file.write('literal,"[\'author\']",[],"[u\'title\']"\r\n')
+        registry = FieldRegistry()
+        registry.from_csv(filepath)
+
+        self.assertEqual(registry.get('json'), ({'author'}, set(), {'author_id', 'title'}))
+        self.assertEqual(registry.get('literal'), ({'author'}, set(), {'title'}))
+
+    def test_csv_replaces_values_without_clear(self):
+        registry = FieldRegistry()
+        registry.add('key', FieldRegistry.ONLY, 'name')
+        filepath = self.get_csv_path()
+        with open(filepath, 'w') as csv_file:
+            csv_file.write('key,,,title\r\n')
+        registry.from_csv(filepath, clear=False)
+
+        self.assertEqual(registry.get('key'), (set(), set(), {'title'}))
+
+    def get_csv_path(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, True)
+        return os.path.join(location, 'registry.csv')
+
+
+@override_settings(DJANGO_OPTIMIZER_CODE_REGISTRY={
+    'BACKEND': 'django_optimizer.cache.PersistentLocMemCache',
+    'LOCATION': 'django_optimizer_tests_code_registry'
+})
+class CodeRegistryTestCase(SimpleTestCase):
+    def setUp(self):
+        CodeRegistry().clear()
+
+    def test_clear_drops_kept_values(self):
+        registry = CodeRegistry()
+        registry.add('key', ".only('name')")
+        registry.clear()
+        registry.add('key', ".only('name')")
+
+        self.assertEqual(CodeRegistry().get('key'), ".only('name')")
+
+    def test_apply_to_code_annotates_lines_of_every_file(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, True)
+        with open(os.path.join(location, 'views.py'), 'w') as code_file:
+            code_file.write('books = Book.objects.all()\r\nauthors = Author.objects.all()\nreturn books\n')
+        with open(os.path.join(location, 'other.py'), 'w') as code_file:
+            code_file.write('tags = Tag.objects.all()\n')
+
+        registry = CodeRegistry()
+        registry.add('views.py::book::1', ".only('title')")
+        registry.add('views.py::author::2', ".only('name')")
+        registry.add('other.py::tag::1', '')
+        registry.add('views.py/scope/book', ".only('pages')")
+        with override_settings(BASE_DIR=location):
+            registry.apply_to_code()
+
+        with open(os.path.join(location, 'views.py')) as code_file:
+            self.assertEqual(code_file.read(), (
+                "books = Book.objects.all()  # django_optimizer (book): .only('title')\n"
+                "authors = Author.objects.all()  # django_optimizer (author): .only('name')\n"
+                "return books\n"
+            ))
+        with open(os.path.join(location, 'other.py')) as code_file:
+            self.assertEqual(code_file.read(), 'tags = Tag.objects.all()  # django_optimizer (tag): \n')
+
+
+class PersistentFileBasedCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, True)
+
+    def get_cache(self):
+        # writer thread doesn't save values during a test, so only explicit flushes do
+        return PersistentFileBasedCache(self.location, {'OPTIONS': {'FLUSH_INTERVAL': 60}})
+
+    def test_values_are_saved_on_flush(self):
+        cache = self.get_cache()
+        cache.set('key', 'value')
+        cache.set_many({'many': 'value', 'deleted': 'value'})
+        cache.delete('deleted')
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertIsNone(self.get_cache().get('key'))
+
+        cache.flush()
+        other = self.get_cache()
+        self.assertEqual((other.get('key'), other.get('many'), other.get('deleted')), ('value', 'value', None))
+
+    def test_values_keep_their_types(self):
+        values = {
+            'fields': (frozenset(['author']), frozenset(), frozenset(['author_id', 'title'])),
+            'keys': {'first', 'second'},
+            'text': u'text',
+            'safe': SafeText(u'safe'),
+            'number': Number(1),
+            'dict': {'key': [1, None]},
+        }
+        cache = self.get_cache()
+        cache.set_many(values)
+        cache.flush()
+
+        for stored in (cache, self.get_cache()):
+            for key, value in values.items():
+                stored_value = stored.get(key)
+                self.assertEqual(stored_value, value)
+                self.assertIs(type(stored_value), type(value))
+        self.assertIsNot(cache.get('keys'), cache.get('keys'))
+
+    def test_marshal_is_used_only_for_exact_builtin_types(self):
+        self.assertEqual(_dumps((frozenset(['author']), [1, u'text', None], {'key': 1.5}))[:1], b'm')
+        self.assertEqual(_dumps(SafeText(u'safe'))[:1], b'p')
+        self.assertEqual(_dumps([SafeText(u'safe')])[:1], b'p')
+
+    def test_value_written_by_file_based_cache_is_read(self):
+        FileBasedCache(self.location, {}).set('key', {'value'})
+
+        self.assertEqual(self.get_cache().get('key'), {'value'})
+
+    def test_merge_is_applied_to_value_stored_by_other_process(self):
+        first, second = self.get_cache(), self.get_cache()
+        first.get('key')
+        second.get('key')
+        first.set('key', {'first'}, merge=lambda value: value | {'first'})
+        first.flush()
+        second.set('key', {'second'}, merge=lambda value: value | {'second'})
+        second.flush()
+
+        self.assertEqual(self.get_cache().get('key'), {'first', 'second'})
+        self.assertEqual(second.get('key'), {'first', 'second'})
+
+    def test_value_set_without_merge_replaces_stored_one(self):
+        first, second = self.get_cache(), self.get_cache()
+        first.set('key', {'first'}, merge=lambda value: value | {'first'})
+        first.flush()
+        second.set('key', {'second'})
+        second.set('key', {'second', 'third'}, merge=lambda value: value | {'third'})
+        second.flush()
+
+        self.assertEqual(self.get_cache().get('key'), {'second', 'third'})
+
+    def test_removed_registry_key_is_not_restored_on_flush(self):
+        with override_settings(DJANGO_OPTIMIZER_FIELD_REGISTRY={
+            'BACKEND': 'django_optimizer.cache.PersistentFileBasedCache',
+            'LOCATION': self.location
+        }):
+            first, second = FieldRegistry(), FieldRegistry()
+            first.add('first', FieldRegistry.ONLY, 'name')
+            first.cache.flush()
+            second.add('second', FieldRegistry.ONLY, 'name')
+            second.cache.flush()
+            first.remove_key('first')
+            first.cache.flush()
+
+            self.assertEqual(FieldRegistry().get_keys(), {'second'})
+
+
+class SelectiveQuerySetTestCase(SimpleTestCase):
+    def test_clone_retrieves_location_only_if_retrieved_before(self):
+        queryset = SelectiveQuerySet(DeferredAuthor).filter(name='name')
+        self.assertNotIn('_location', queryset.__dict__)
+
+        location = queryset._location
+        self.assertIs(queryset.filter(name='other')._location, location)
+
+    @override_settings(BASE_DIR=BASE_DIR)
+    def test_nullable_fields_are_not_selected_for_update(self):
+        queryset = SelectiveQuerySet(DeferredBook).select_for_update().select_related('author', 'editor')
+        queryset._optimize()
+
+        self.assertEqual(queryset.query.select_related, {'author': {}})
+
+    @override_settings(BASE_DIR=BASE_DIR)
+    def test_nullable_fields_are_selected_without_update(self):
+        queryset = SelectiveQuerySet(DeferredBook).select_related('author', 'editor')
+        queryset._optimize()
+
+        self.assertEqual(queryset.query.select_related, {'author': {}, 'editor': {}})
+
+
+class ObjectLocationTestCase(SimpleTestCase):
+    def test_location_with_unicode_base_dir(self):
+        with override_settings(BASE_DIR=six.text_type(BASE_DIR)):
+            location = ObjectLocation('Name', False)
+
+        self.assertEqual((location.scope, location.name), ('test_location_with_unicode_base_dir', 'name'))
+
+    @override_settings(BASE_DIR=BASE_DIR)
+    def test_numbered_locations_are_created_once_per_line(self):
+        count = len(_numbered_locations)
+        locations = [ObjectLocation(name, True) for name in ('Name', 'Name', 'Other')]
+
+        self.assertEqual(len(_numbered_locations), count + 2)
+        self.assertEqual(str(locations[0]), str(locations[1]))
+        self.assertNotEqual(str(locations[0]), str(locations[2]))
+        self.assertTrue(str(locations[0]).endswith('::name::{}'.format(locations[0].number)))
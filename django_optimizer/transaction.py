@@ -3,38 +3,79 @@
 Transaction module storing DeferredAtomic context manager,
 which delays db saves and tries to perform them later in bulk operations
 """
-import copy
-
 from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.transaction import get_connection
-from django.utils.functional import partition
 from django_bulk_update.helper import bulk_update
 
+from django_optimizer.conf import settings
 from django_optimizer.registry import model_registry
 
+_deferred_instance_refs = {}
+"""
+Weak references to instances which saves were deferred, by their ids, kept until instances are collected
+"""
+
 
 def get_db_instance(obj, with_ref=False, *args):
-    instance = copy.copy(obj)
-    for attr in ('_queryset', 'instance_getattribute', 'refresh_from_db') + args:
-        instance.__dict__.pop(attr, None)
+    # a shallow copy is made directly from instance dict, skipping copy protocol run through Model.__reduce__()
+    model = type(obj)
+    instance = model.__new__(model)
+    data = obj.__dict__.copy()
+    for attr in ('_queryset', 'instance_getattribute') + args:
+        data.pop(attr, None)
+    instance.__dict__ = data
     if with_ref:
         instance._deferred_obj = id(obj)
     return instance
 
 
-def perform_deferred_db_queries(only_model=None):
+def perform_deferred_db_queries(only_model=None, using=None):
     def _without_ids(iterable):
         for i in iterable:
             i.id = None
             yield i
 
+    # saved copies are matched with instances by their ids in _mark_saved()
+    model_registry.remove_collected_refs()
     key = model_registry.get_key_from_model(only_model)
-    if not key or model_registry.has_key(key):
-        pairs = model_registry.pop_pair(key) if key else model_registry.pop_all()
-        for model, objects in pairs:
-            to_update, to_create = partition(lambda obj: obj._state.adding, objects)
-            model.objects.bulk_create(_without_ids(to_create))
-            bulk_update(to_update)
+    if key and not model_registry.has_key(key):
+        return
+    keys = {key} if key else model_registry.get_thread_keys()
+    if not keys:
+        return
+    pairs = model_registry.get_pairs(keys)
+    # lists of a model may be empty after deletions, then no transaction is opened
+    if any(to_create or to_update for _, (to_create, to_update) in pairs):
+        # queries of all models are committed at once, instead of each bulk query committing separately,
+        # every query is run on a connection of this transaction
+        using = using or DEFAULT_DB_ALIAS
+        with transaction.atomic(using=using, savepoint=False):
+            for model, (to_create, to_update) in pairs:
+                model.objects.db_manager(using).bulk_create(
+                    _without_ids(to_create), batch_size=settings.DJANGO_OPTIMIZER_DEFERRED_BATCH_SIZE
+                )
+                bulk_update(to_update, using=using, batch_size=settings.DJANGO_OPTIMIZER_DEFERRED_BATCH_SIZE)
+        for _, (to_create, to_update) in pairs:
+            _mark_saved(to_create + to_update)
+    # objects are removed after queries succeed, so that they're still pending if any of them fails
+    model_registry.remove(keys)
+
+
+def _mark_saved(objects):
+    """
+    Passes saved copies to DeferredPK of their instances, so that reading pk doesn't insert them again
+
+    Queries may be performed before the end of deferred_atomic block, while instances are still in use
+
+    :param objects: objects from model registry, which were written to db
+    """
+    for obj in objects:
+        ref = _deferred_instance_refs.get(obj._deferred_obj)
+        instance = ref() if ref is not None else None
+        if instance is not None:
+            deferred_pk = instance.__dict__.get(instance._meta.pk.attname)
+            if type(deferred_pk) is DeferredPK:
+                deferred_pk.saved_instance = obj
 
 
 class DeferredPK(object):
@@ -43,11 +84,15 @@ class DeferredPK(object):
 
     When object's save() is deferred and its pk is accessed before usual bulk create,
     then the insertion query is executed immediately and its pk gets returned
+
+    If object was already written by bulk operations, pk is taken from its saved copy instead
     """
-    def __init__(self, instance, *args, **kwargs):
+    __slots__ = ('instance', 'field_name', 'saved_instance')
+
+    def __init__(self, instance):
         self.instance = instance
         self.field_name = instance._meta.pk.attname
-        super(DeferredPK, self).__init__(*args, **kwargs)
+        self.saved_instance = None
 
     def _save_and_retrieve_pk(self):
         model = self.instance._meta.model
@@ -56,21 +101,46 @@ class DeferredPK(object):
         db_row = model.objects.bulk_create([db_instance])[0]
         model_registry.delete(db_instance)
 
-        if not hasattr(db_row, self.field_name):
-            field_names = [f.name for f in self.instance._meta.get_fields()]
-            db_row = model.objects.filter(
-                **{field: self.instance.__dict__[field] for field in self.instance.__dict__ if field in field_names}
-            ).last()
-
-        field_value = getattr(db_row, self.field_name)
+        field_value = self._retrieve_pk(db_row, inserted_last=True)
         setattr(self.instance, self.field_name, field_value)
 
         return field_value
 
+    def _retrieve_pk(self, db_instance, inserted_last=False):
+        """
+        Gets pk of a row written for given copy of an instance
+
+        Backends that don't return ids from bulk inserts leave pk empty, then only pk of a row is queried,
+        filtering on values of concrete fields of a copy. Rows with the same values can't be told apart,
+        unless a copy was inserted just now, then its row is the latest one in insert order
+
+        :param db_instance: copy of an instance, which was written to db
+        :param inserted_last: whether copy is the latest row inserted in its table
+        :return: pk value
+        """
+        model = self.instance._meta.model
+        field_value = db_instance.__dict__.get(self.field_name)
+        if field_value is None:
+            field_values = list(model.objects.filter(**{
+                f.attname: db_instance.__dict__[f.attname]
+                for f in model._meta.concrete_fields if not f.primary_key and f.attname in db_instance.__dict__
+            }).order_by('-pk').values_list(self.field_name, flat=True)[:2])
+            if len(field_values) > 1 and not inserted_last:
+                raise model.MultipleObjectsReturned(
+                    "Deferred pk of {} can't be retrieved, as there are many rows with the same values".format(
+                        model.__name__
+                    )
+                )
+            field_value = field_values[0] if field_values else None
+        return field_value
+
     def get_value(self):
         data = self.instance.__dict__
         if isinstance(data.get(self.field_name, self), DeferredPK):
-            data[self.field_name] = self._save_and_retrieve_pk()
+            if self.saved_instance is None:
+                data[self.field_name] = self._save_and_retrieve_pk()
+            else:
+                data[self.field_name] = self._retrieve_pk(self.saved_instance)
         return data[self.field_name]
 
 
@@ -90,7 +160,7 @@ class DeferredAtomic(transaction.Atomic):
     def __exit__(self, exc_type, exc_value, traceback):
         super(DeferredAtomic, self).__exit__(exc_type, exc_value, traceback)
         delattr(get_connection(self.using), self.connection_attr_name)
-        perform_deferred_db_queries()
+        perform_deferred_db_queries(using=self.using)
 
 
 def deferred_atomic(using=None, savepoint=True):
@@ -4,14 +4,23 @@ Wrappers module contains wrappers to both django object instances modified by an
 """
 import types
 
-from django.core.exceptions import FieldDoesNotExist
 from django.db import models
-from django_optimizer.registry import field_registry
+from django.db.models.query_utils import DeferredAttribute
 
 from django_optimizer.conf import settings
 from django_optimizer.location import ObjectLocation
 from django_optimizer.query import SelectiveQuerySet
 
+_selective_query_set_classes = {}
+"""
+Queryset classes with SelectiveQuerySet mixin, by classes of wrapped querysets, created once for every class
+"""
+
+_logging_descriptor_classes = {}
+"""
+Descriptor classes with logging mixins, by mixin and class of wrapped descriptor, created once for every pair
+"""
+
 
 def selective_query_set_wrapper(model):
     """
@@ -23,75 +32,137 @@ def selective_query_set_wrapper(model):
     queryset = model.objects.all()
 
     if not isinstance(queryset, SelectiveQuerySet):
-        queryset.__class__ = type(
-            'DjangoSelective' + type(queryset).__name__,
-            (SelectiveQuerySet, type(queryset)),
-            {}
-        )
+        queryset_class = type(queryset)
+        try:
+            queryset.__class__ = _selective_query_set_classes[queryset_class]
+        except KeyError:
+            queryset.__class__ = _selective_query_set_classes[queryset_class] = type(
+                'DjangoSelective' + queryset_class.__name__,
+                (SelectiveQuerySet, queryset_class),
+                {}
+            )
 
         # __init__() instructions have to be run explicitly
+        # location is the same as the one of a queryset running this function, so it's retrieved here too
         queryset._live_optimization = settings.DJANGO_OPTIMIZER_LIVE_OPTIMIZATION
         queryset._offsite_optimization = settings.DJANGO_OPTIMIZER_OFFSITE_OPTIMIZATION
         queryset._location = ObjectLocation(queryset.model.__name__, queryset._offsite_optimization)
-        queryset._registry_fields = field_registry.get(queryset._location)
-        queryset._without_only = not queryset._registry_fields[field_registry.ONLY]
 
     return queryset
 
 
-def logging_model_wrapper(model):
+def get_logged_field_names(model_class):
+    """
+    Gets names of fields, which usage is gathered for only(), computed once for every model class
+
+    Contains both names and attnames of fields, like ``_meta.get_field()`` which was used to check them before
+
+    :param model_class: model class of logged instances
+    :return: frozenset of field names
     """
-    Adds modified `__getattribute__` and `refresh_from_db` definitions to model instance
+    try:
+        return model_class.__dict__['_logged_field_names']
+    except KeyError:
+        field_names = frozenset(
+            name
+            for field in model_class._meta.get_fields() if isinstance(field, models.Field)
+            for name in (field.name, field.attname) if name != 'id' and not name.startswith('_')
+        )
+        model_class._logged_field_names = field_names
+        return field_names
+
 
-    :param model: input model instance
-    :return: wrapped object
+def get_logging_model_wrapper(model_class):
     """
-    def _add_select_field(obj, field_obj):
-        to_one = field_obj.one_to_one or field_obj.many_to_one
-        no_cache = not hasattr(obj, field_obj.get_cache_name())
-        if to_one and no_cache:
-            obj._queryset._add_select(field_obj.name)
-
-    def _add_prefetch_field(obj, field_obj):
-        to_many = field_obj.one_to_many or field_obj.many_to_many
-        prefetch_lookup_names = [
-            getattr(lookup, 'prefetch_through', str(lookup))
-            for lookup in obj._queryset._prefetch_related_lookups
-        ]
-        no_name = field_obj.name not in prefetch_lookup_names
-        if to_many and no_name:
-            obj._queryset._add_prefetch(field_obj.name)
-
-    def _add_related_field(obj, field_obj, item):
-        is_relation = field_obj.is_relation
-        is_exact_field = item == field_obj.name
-        if is_relation and is_exact_field:
-            _add_select_field(obj, field_obj)
-            _add_prefetch_field(obj, field_obj)
-
-    def _add_value_field(obj, item):
-        if obj._queryset._without_only:
-            obj._queryset._add_only(item)
+    Gets a function adding modified `__getattribute__` definition to instances of a model class
+
+    Relations and deferred fields are logged by descriptors wrapped in logging_descriptor_wrapper(),
+    so this is needed only to gather fields for only() when queryset doesn't have these in registry yet
+
+    Modified `__getattribute__` and field names are resolved once, so that for every instance fetched
+    by a queryset the wrapper only binds it to instance
 
+    :param model_class: model class of logged instances
+    :return: function wrapping model instance
+    """
     def instance_getattribute(self, item):
-        if item != 'id' and not item.startswith('_'):
-            try:
-                field = self._meta.get_field(item)
-                if isinstance(field, models.Field):
-                    _add_value_field(self, item)
-                    _add_related_field(self, field, item)
-            except FieldDoesNotExist:
-                pass
+        if item in field_names:
+            self._queryset._add_only(item)
         return object.__getattribute__(self, item)
 
-    def refresh_from_db(self, using=None, fields=None):
-        if fields:
-            for field in fields:
-                self._queryset._add_only(field)
-        super(type(self), self).refresh_from_db(using, fields)
-
-    if not isinstance(model, dict):
+    def wrapper(model):
         model.instance_getattribute = types.MethodType(instance_getattribute, model)
-        model.refresh_from_db = types.MethodType(refresh_from_db, model)
+        return model
+
+    field_names = get_logged_field_names(model_class)
+    return wrapper
+
 
-    return model
+class LoggingDescriptorMixin(object):
+    """
+    Mixin for django's descriptors of model fields, which logs field usage to queryset an instance was fetched from
+
+    Values needed on access are computed once in logging_descriptor_wrapper(), so that access to any other attribute
+    of a model instance doesn't need to be intercepted
+    """
+    def __get__(self, instance, cls=None):
+        if instance is not None:
+            queryset = instance.__dict__.get('_queryset')
+            if queryset is not None:
+                self._log_field(instance, queryset)
+        return super(LoggingDescriptorMixin, self).__get__(instance, cls)
+
+    def _log_field(self, instance, queryset):
+        pass
+
+
+class LoggingRelatedDescriptorMixin(LoggingDescriptorMixin):
+    """
+    Logs fields for select_related() and prefetch_related() on access to related descriptor
+    """
+    def _log_field(self, instance, queryset):
+        if self.logged_select and self.logged_cache_name not in instance.__dict__:
+            queryset._add_select(self.logged_name)
+        if self.logged_prefetch and self.logged_name not in queryset._prefetch_lookup_names:
+            queryset._add_prefetch(self.logged_name)
+
+
+class LoggingDeferredAttributeMixin(LoggingDescriptorMixin):
+    """
+    Logs fields for only() on access to DeferredAttribute, which is used only with fields missing in instance dict
+
+    These fields were deferred by only() and are loaded with refresh_from_db() one by one
+    """
+    def _log_field(self, instance, queryset):
+        queryset._add_only(self.field_name)
+
+
+def logging_descriptor_wrapper(descriptor, field):
+    """
+    Adds logging mixin to descriptor instance and stores values needed to log accessed field
+
+    :param descriptor: related descriptor or DeferredAttribute instance, which provides access to field in model class
+    :param field: field defining this descriptor
+    :return: wrapped descriptor object
+    """
+    if not isinstance(descriptor, LoggingDescriptorMixin):
+        if isinstance(descriptor, DeferredAttribute):
+            mixin = LoggingDeferredAttributeMixin
+        else:
+            mixin = LoggingRelatedDescriptorMixin
+            descriptor.logged_name = field.name
+            descriptor.logged_select = field.one_to_one or field.many_to_one
+            descriptor.logged_prefetch = field.one_to_many or field.many_to_many
+            descriptor.logged_cache_name = field.get_cache_name()
+
+        descriptor_class = type(descriptor)
+        try:
+            descriptor.__class__ = _logging_descriptor_classes[mixin, descriptor_class]
+        except KeyError:
+            descriptor.__class__ = _logging_descriptor_classes[mixin, descriptor_class] = type(
+                'Logging' + descriptor_class.__name__,
+                (mixin, descriptor_class),
+                {}
+            )
+
+    return descriptor